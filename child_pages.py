@@ -4,9 +4,9 @@
 # --------------------------------------------------------------------------------------------------
 """
 
+import concurrent.futures
 import urllib
 import urllib.parse
-import json
 
 import common
 
@@ -21,17 +21,24 @@ class _ChildPageTracker:
     """
 
     __ORIGINAL_CHILD_PAGES = {}
-    __ACTIVE_PAGES = []
-    __CHILD_PAGES_CACHE = {}
+    __ACTIVE_PAGES = set()
 
     def track_child_pages(self):
         """
         Start tracking child pages under the ANCESTOR
         """
-        # get the pages that are currently under the ancestor
+        # get the pages that are currently under the ancestor, then pull
+        # each child's entire subtree with the bulk descendant endpoint;
+        # one paged request per direct child replaces one request per
+        # page, and the requests run concurrently
         direct_child_pages = self.__get_direct_child_pages(ANCESTOR)
-        for child in direct_child_pages:
-            self.__ORIGINAL_CHILD_PAGES[child] = self.__get_child_pages(child)
+        LOGGER.info('Retrieving information of original child pages')
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            subtrees = executor.map(self.__get_descendant_pages,
+                                    direct_child_pages)
+            self.__ORIGINAL_CHILD_PAGES.update(
+                dict(zip(direct_child_pages, subtrees)))
 
 
     def mark_page_active(self, page):
@@ -41,8 +48,10 @@ class _ChildPageTracker:
 
         :param page: Page which is known to be active
         """
-        if not page in self.__ACTIVE_PAGES:
-            self.__ACTIVE_PAGES.append(page)
+        # simulate mode passes a placeholder instead of a page id;
+        # there is nothing to track (and a list cannot go in a set)
+        if page:
+            self.__ACTIVE_PAGES.add(page)
 
 
     def trash_needed(self):
@@ -67,6 +76,7 @@ class _ChildPageTracker:
         # page under the ancestor, and its children, are spared; but
         # any children under any page that we have touched are fair
         # game to be removed
+        to_delete = []
         for original_child_page in self.__ORIGINAL_CHILD_PAGES:
             if original_child_page not in self.__ACTIVE_PAGES:
                 LOGGER.info("Sparing original page: %s", original_child_page)
@@ -77,29 +87,28 @@ class _ChildPageTracker:
                             LOGGER.info('Original page with page id %s has no markdown file to '
                                         'update from, so it will be deleted.', child)
                         else:
-                            self.__delete_page(child, trash_ancestor)
+                            to_delete.append(child)
+
+        # each deletion is an independent GET + PUT round-trip; fan them
+        # out over a thread pool sharing the pooled session
+        if to_delete:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+                list(executor.map(
+                    lambda child: self.__delete_page(child, trash_ancestor),
+                    to_delete))
 
 
-    def __get_child_pages(self, page_id):
+    def __get_descendant_pages(self, page_id):
         """
-        Retrieve details of the child pages by page id
+        Retrieve every descendant page id, however deep, in one paged
+        request stream
 
         :param page_id: page id
-        :return: the ids of all the child pages
+        :return: ids of all descendant pages
         """
-        if page_id in self.__CHILD_PAGES_CACHE:
-            return self.__CHILD_PAGES_CACHE[page_id]
-
-        LOGGER.info('Retrieving information of original child pages: %s', page_id)
-        page_ids = self.__get_direct_child_pages(page_id)
-
-        for page_id in page_ids:
-            child_pages = self.__get_child_pages(page_id)
-            if child_pages:
-                page_ids = page_ids + list(set(child_pages) - set(page_ids))
-
-        self.__CHILD_PAGES_CACHE[page_id] = page_ids
-        return page_ids
+        url = '%s/rest/api/content/%s/descendant/page?limit=200&expand=' % \
+            (CONFLUENCE_API_URL, urllib.parse.quote_plus(page_id))
+        return self.__collect_page_ids(url)
 
 
     def __get_direct_child_pages(self, page_id):
@@ -109,16 +118,33 @@ class _ChildPageTracker:
         :param page_id: page id
         :return: ids of immediate child pages
         """
-        url = '%s/rest/api/content/search?cql=parent=%s' % \
+        # only the page ids are used, so ask for no expansions and a
+        # large batch size to keep the response payload small
+        url = '%s/rest/api/content/search?cql=parent=%s&limit=200&expand=' % \
             (CONFLUENCE_API_URL, urllib.parse.quote_plus(page_id))
+        return self.__collect_page_ids(url)
 
-        response = common.make_request_get(url)
-        data = response.json()
-        LOGGER.debug("data: %s", str(data))
 
+    @staticmethod
+    def __collect_page_ids(url):
+        """
+        Collect page ids from a content query, following the
+        cursor-style next links until the results run out
+
+        :param url: first page of the content query
+        :return: ids from every batch
+        """
         page_ids = []
-        for result in data[u'results']:
-            page_ids.append(result[u'id'])
+        while url:
+            response = common.make_request_get(url)
+            data = response.json()
+            LOGGER.debug("data: %s", str(data))
+
+            for result in data[u'results']:
+                page_ids.append(result[u'id'])
+
+            next_path = data.get(u'_links', {}).get(u'next')
+            url = (CONFLUENCE_API_URL + next_path) if next_path else None
 
         return page_ids
 
@@ -154,9 +180,10 @@ class _ChildPageTracker:
             },
             'ancestors': ancestors
         }
-        LOGGER.debug("data: %s", json.dumps(page_json))
+        payload = common.json_dumps(page_json)
+        LOGGER.debug("data: %s", payload)
 
-        common.make_request_put(url, data=json.dumps(page_json))
+        common.make_request_put(url, data=payload)
 
 
 CHILD_PAGES = _ChildPageTracker()
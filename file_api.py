@@ -5,11 +5,12 @@
 """
 
 import os
+import atexit
 import tempfile
-import codecs
+import threading
+import collections
 from pathlib import Path
 import hashlib
-import markdown
 
 from globals import LOGGER
 from globals import LOG_FILE
@@ -19,13 +20,92 @@ from globals import CONTENTS
 import macros
 from page_cache import PAGE_CACHE
 
+
+# one converter instance, reused for every file; building a Markdown
+# object registers extensions and compiles their patterns each time;
+# created on first use so that startup does not pay the markdown import.
+# convert() mutates the instance, so conversions are serialized
+_MD_CONVERTER = None
+_MD_CONVERTER_LOCK = threading.Lock()
+
+# converted html persists across runs keyed by content hash, so a rerun
+# after editing one file only re-converts that file
+_CONVERSION_CACHE_DIR = os.path.join(
+    os.path.expanduser('~'), '.cache', 'md2conf')
+
+
+def _get_md_converter():
+    global _MD_CONVERTER
+    if _MD_CONVERTER is None:
+        import markdown
+        _MD_CONVERTER = markdown.Markdown(
+            extensions=['markdown.extensions.tables',
+                        'markdown.extensions.fenced_code',
+                        'markdown.extensions.sane_lists'])
+    return _MD_CONVERTER
+
+
+def _remove_silently(path):
+    """
+    Remove a file, ignoring it if it is already gone
+
+    :param path: file to remove
+    """
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _cache_key(filepath):
+    """
+    Normalize a file path for use as a cache key; callers pass a mix of
+    str and Path objects, and relative and absolute variants
+
+    :param filepath: path to normalize
+    :return: canonical cache key for the file
+    """
+    return os.path.realpath(os.fspath(filepath))
+
+
+_FileContent = collections.namedtuple('FileContent', ['title', 'sha256', 'text'])
+
+
 class _FileApi:
     """
     APIS that deal with local files
     """
 
     __TITLE_CACHE_BY_FILE = {}
+    __TITLES_IN_USE = set()
+    __TITLE_LOCK = threading.Lock()
     __SHA_HASH_BY_FILE = {}
+    __FILE_CONTENT_CACHE = {}
+    __LANDING_PAGE_FILES = {}
+
+    def __load(self, filepath):
+        """
+        Read a markdown file once, producing its raw title, content hash
+        and text in a single pass; cached by real path and mtime so an
+        edited file is re-read
+
+        :param filepath: full path to markdown file
+        :return: FileContent for the file
+        """
+        key = _cache_key(filepath)
+        mtime = os.stat(key).st_mtime_ns
+        cached = self.__FILE_CONTENT_CACHE.get(key)
+        if cached and cached[0] == mtime:
+            return cached[1]
+
+        with open(key, 'rb') as handle:
+            raw = handle.read()
+
+        text = raw.decode('utf-8')
+        title = text.split('\n', 1)[0].lstrip('#').strip()
+        content = _FileContent(title, hashlib.sha256(raw).hexdigest(), text)
+        self.__FILE_CONTENT_CACHE[key] = (mtime, content)
+        return content
 
     def get_html(self, filepath):
         """
@@ -34,12 +114,7 @@ class _FileApi:
         :param filepath: the file to translate to html
         :return: html translation
         """
-        with codecs.open(filepath, 'r', 'utf-8') as mdfile:
-            read = mdfile.read()
-            read = macros.remove_collapsible_headings(read)
-            html = markdown.markdown(read, extensions=['markdown.extensions.tables',
-                                                    'markdown.extensions.fenced_code',
-                                                    'markdown.extensions.sane_lists'])
+        html = self.__convert(self.__load(filepath))
         html = '\n'.join(html.split('\n')[1:])
         html = macros.add_note(html)
         html = macros.convert_info_macros(html)
@@ -53,15 +128,52 @@ class _FileApi:
         html = PAGE_CACHE.resolve_refs(html, filepath)
         if LOG_HTML:
             title = self.get_title(filepath)
-            html_log_file = open(os.path.dirname(LOG_FILE) + title + '.html', 'w+')
-            html_log_file.write('<h1>' + title + '</h1>')
-            html_log_file.write(html)
+            # write and close in one shot; the old bare open leaked a
+            # file descriptor per page for the rest of the run
+            Path(os.path.dirname(LOG_FILE) + title + '.html') \
+                .write_text('<h1>' + title + '</h1>' + html)
         else:
             LOGGER.debug('file: %s\n\nhtml: %s\n\n', filepath, html)
 
         return html
 
 
+    def __convert(self, content):
+        """
+        Convert loaded markdown to html, consulting the on-disk cache;
+        the conversion is a pure function of the file content, so the
+        content hash is the cache key
+
+        :param content: FileContent to convert
+        :return: html translation, before any macro processing
+        """
+        cache_file = os.path.join(_CONVERSION_CACHE_DIR, content.sha256 + '.html')
+        try:
+            # pin the encoding: cache entries must round-trip across
+            # runs regardless of the active locale
+            with open(cache_file, 'r', encoding='utf-8') as handle:
+                return handle.read()
+        except OSError:
+            pass
+
+        read = macros.remove_collapsible_headings(content.text)
+        # upload workers reach this path through image sub-pages and the
+        # ref resolution pass; two interleaved convert() calls on the
+        # shared instance would corrupt both results
+        with _MD_CONVERTER_LOCK:
+            html = _get_md_converter().reset().convert(read)
+
+        # write through a temp file and rename, so a crashed or
+        # concurrent run can never leave a half-written cache entry
+        os.makedirs(_CONVERSION_CACHE_DIR, exist_ok=True)
+        handle = tempfile.NamedTemporaryFile(
+            mode='w', encoding='utf-8', dir=_CONVERSION_CACHE_DIR, delete=False)
+        handle.write(html)
+        handle.close()
+        os.replace(handle.name, cache_file)
+        return html
+
+
     def get_title(self, filepath):
         """
         Returns confluence page title extracted from the markdown file
@@ -69,43 +181,62 @@ class _FileApi:
         :param filepath: full path to  markdown file
         :return: confluence page title
         """
-        if filepath in self.__TITLE_CACHE_BY_FILE:
-            return self.__TITLE_CACHE_BY_FILE[filepath]
-        with open(filepath, 'r') as mdfile:
-            title = mdfile.readline().lstrip('#').strip()
-            mdfile.seek(0)
+        key = _cache_key(filepath)
+        # upload worker threads allocate titles too (image sub-pages),
+        # so the check-then-record on the shared caches must be atomic
+        # or two files could claim the same title
+        with self.__TITLE_LOCK:
+            if key in self.__TITLE_CACHE_BY_FILE:
+                return self.__TITLE_CACHE_BY_FILE[key]
+            title = self.__load(filepath).title
 
-        basetitle = title
-        i = 0
-        while (title in self.__TITLE_CACHE_BY_FILE.values()) or \
-              (PAGE_CACHE.is_page_unowned(title)):
-            i += 1
-            title = '%s (%d)' % (basetitle, i)
+            basetitle = title
+            i = 0
+            while (title in self.__TITLES_IN_USE) or \
+                  (PAGE_CACHE.is_page_unowned(title)):
+                i += 1
+                title = '%s (%d)' % (basetitle, i)
 
-        self.__TITLE_CACHE_BY_FILE[filepath] = title
+            self.__TITLE_CACHE_BY_FILE[key] = title
+            self.__TITLES_IN_USE.add(title)
 
         LOGGER.info('Title: %s', title)
         return title
 
 
-    def get_landing_page_doc_file(self, directory):
+    def get_landing_page_doc_file(self, directory, entries=None):
         """
         Get full file path to the markdown file corresponding to the directory
 
         :param directory: the directory
+        :param entries: optional pre-scanned entries for the directory,
+                        saving a stat when the caller already walked it
         :return: full path to corresponding landing page markdown file
         """
 
         # if the directory contains a README.md, use that
         file = Path(directory) / 'README.md'
-        if os.path.exists(file):
+        if entries is not None:
+            has_readme = any(entry.name == 'README.md' and entry.is_file()
+                             for entry in entries)
+        else:
+            has_readme = os.path.exists(file)
+        if has_readme:
             return file
 
-        # fall back on creating a file containing only the directory name
+        # fall back on creating a file containing only the directory
+        # name; created at most once per directory and removed at exit
+        # rather than left behind in the temp folder
+        key = os.path.realpath(os.fspath(directory))
+        if key in self.__LANDING_PAGE_FILES:
+            return self.__LANDING_PAGE_FILES[key]
+
         file = tempfile.NamedTemporaryFile(mode='w', delete=False)
         file.write('# ' + os.path.basename(directory) + '\n')
         file.close()
-        return Path(file.name)
+        atexit.register(_remove_silently, file.name)
+        self.__LANDING_PAGE_FILES[key] = Path(file.name)
+        return self.__LANDING_PAGE_FILES[key]
 
 
     def get_sha_hash(self, file):
@@ -117,15 +248,20 @@ class _FileApi:
         if file in self.__SHA_HASH_BY_FILE:
             return self.__SHA_HASH_BY_FILE[file]
 
-        sha256 = hashlib.sha256()
-        with open(file, 'rb') as handle:
-            while True:
-                data = handle.read(65536)
-                if not data:
-                    break
-                sha256.update(data)
+        # markdown files already loaded get their hash for free
+        cached = self.__FILE_CONTENT_CACHE.get(_cache_key(file))
+        if cached:
+            return cached[1].sha256
 
-        digest = sha256.hexdigest()
+        with open(file, 'rb') as handle:
+            try:
+                # single C-level pass, releases the GIL (Python 3.11+)
+                digest = hashlib.file_digest(handle, 'sha256').hexdigest()
+            except AttributeError:
+                sha256 = hashlib.sha256()
+                for data in iter(lambda: handle.read(65536), b''):
+                    sha256.update(data)
+                digest = sha256.hexdigest()
         self.__SHA_HASH_BY_FILE[file] = digest
         return digest
 
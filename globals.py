@@ -8,11 +8,7 @@ import logging
 import sys
 import os
 import argparse
-from datetime import datetime
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - \
-%(levelname)-5s - [%(lineno)-3d] %(funcName)-18s - \
-%(message)s')
 LOGGER = logging.getLogger(__name__)
 
 def _get_args():
@@ -21,6 +17,10 @@ def _get_args():
 
     :return: args
     """
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - \
+%(levelname)-5s - [%(lineno)-3d] %(funcName)-18s - \
+%(message)s')
+
     # ArgumentParser to parse arguments and options
     parser = argparse.ArgumentParser()
     parser.add_argument('spacekey', nargs='?',
@@ -74,6 +74,8 @@ def _get_log_file(_args):
     :param args: args
     :return: log file
     """
+    from datetime import datetime
+
     log_file_name = 'logs_' + datetime.now().strftime("%Y_%m_%d-%H_%M") + '.txt'
     log_folder = 'logs/'
     return log_folder + log_file_name
@@ -154,16 +156,42 @@ def _get_note(args):
     return args.note or os.getenv('CONFLUENCE_NOTE')
 
 
-_args = _get_args()
-DOCUMENTATION_ROOTS = _get_documentation_roots(_args)
-LOG_FILE = _get_log_file(_args)
-USERNAME = _get_user_name(_args)
-API_KEY = _get_api_key(_args)
-SPACE_KEY = _get_space_key(_args, USERNAME)
-CONFLUENCE_API_URL = _get_confluence_api_url(_args)
-ANCESTOR = _get_ancestor(_args)
-NOTE = _get_note(_args)
-SIMULATE = _args.simulate
-LOG_HTML = _args.loghtml
-CONTENTS = _args.contents
-NOTRACK = _args.notrack
+_CONFIG = None
+
+def _init():
+    """
+    Parse arguments and compute all configuration values; deferred to
+    first use so that merely importing this module (e.g. from tests or
+    tooling) does not parse the command line or configure logging
+    """
+    global _CONFIG
+    args = _get_args()
+    username = _get_user_name(args)
+    _CONFIG = {
+        'DOCUMENTATION_ROOTS': _get_documentation_roots(args),
+        'LOG_FILE': _get_log_file(args),
+        'USERNAME': username,
+        'API_KEY': _get_api_key(args),
+        'SPACE_KEY': _get_space_key(args, username),
+        'CONFLUENCE_API_URL': _get_confluence_api_url(args),
+        'ANCESTOR': _get_ancestor(args),
+        'NOTE': _get_note(args),
+        'SIMULATE': args.simulate,
+        'LOG_HTML': args.loghtml,
+        'CONTENTS': args.contents,
+        'NOTRACK': args.notrack,
+    }
+    return _CONFIG
+
+
+def __getattr__(name):
+    """
+    Resolve configuration constants lazily (PEP 562); existing
+    `from globals import X` call sites keep working unchanged
+    """
+    config = _CONFIG if _CONFIG is not None else _init()
+    try:
+        return config[name]
+    except KeyError:
+        raise AttributeError(
+            "module %r has no attribute %r" % (__name__, name)) from None
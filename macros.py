@@ -5,10 +5,59 @@
 """
 
 import re
+import functools
+from html import unescape as _unescape
 
 from globals import NOTE
 
 
+# patterns used on every page, compiled once at import
+_CODE_BLOCK_RE = re.compile(r'<pre><code([^>]*)>(.*?)</code></pre>', re.DOTALL)
+_CODE_LANG_RE = re.compile('class="([^"]*)"')
+_BLOCKQUOTE_RE = re.compile('<blockquote>(.*?)</blockquote>', re.DOTALL)
+_NOTE_PREFIX_RE = re.compile('^<.*>Note', re.IGNORECASE)
+_WARNING_PREFIX_RE = re.compile('^<.*>Warning', re.IGNORECASE)
+_DOCTOC_RE = re.compile('<!-- START doctoc.*END doctoc -->', re.DOTALL)
+
+_DOCTOC_MACRO = '''<p>
+    <ac:structured-macro ac:name="toc">
+      <ac:parameter ac:name="printable">true</ac:parameter>
+      <ac:parameter ac:name="style">disc</ac:parameter>
+      <ac:parameter ac:name="maxLevel">7</ac:parameter>
+      <ac:parameter ac:name="minLevel">1</ac:parameter>
+      <ac:parameter ac:name="type">list</ac:parameter>
+      <ac:parameter ac:name="outline">clear</ac:parameter>
+      <ac:parameter ac:name="include">.*</ac:parameter>
+    </ac:structured-macro>
+    </p>'''
+
+_CONTENTS_MACRO = ('<ac:structured-macro ac:name="toc">\n<ac:parameter ac:name="printable">'
+                   'true</ac:parameter>\n<ac:parameter ac:name="style">disc</ac:parameter>'
+                   '<ac:parameter ac:name="maxLevel">5</ac:parameter>\n'
+                   '<ac:parameter ac:name="minLevel">1</ac:parameter>'
+                   '<ac:parameter ac:name="class">rm-contents</ac:parameter>\n'
+                   '<ac:parameter ac:name="exclude"></ac:parameter>\n'
+                   '<ac:parameter ac:name="type">list</ac:parameter>'
+                   '<ac:parameter ac:name="outline">false</ac:parameter>\n'
+                   '<ac:parameter ac:name="include"></ac:parameter>\n'
+                   '</ac:structured-macro>')
+_REFS_RE = re.compile(r'(?:\n|<p>)\[\^(\d)\]([^\n]*)')
+_REF_HREF_RE = re.compile('href="([^"]*)"')
+_REF_MARKER_RE = re.compile(r'\[\^(\d)\]')
+_COLLAPSIBLE_RE = re.compile('</?(?:details|summary)>')
+_LEADING_TAG_RE = re.compile('<[^>]*>')
+# macro wrappers shared by the info/note/warning conversions
+_INFO_TAG = '<p><ac:structured-macro ac:name="info"><ac:rich-text-body><p>'
+_NOTE_TAG = _INFO_TAG.replace('info', 'note')
+_WARNING_TAG = _INFO_TAG.replace('info', 'warning')
+_CLOSE_TAG = '</p></ac:rich-text-body></ac:structured-macro></p>'
+
+# the custom ~?/~!/~% markers, opening and closing forms in one pattern
+_CUSTOM_MARKER_RE = re.compile(r'<p>~([?!%])|([?!%])~</p>')
+_MARKER_TAGS = {'?': _INFO_TAG, '!': _NOTE_TAG, '%': _WARNING_TAG}
+
+
+@functools.lru_cache(maxsize=128)
 def convert_comment_block(html):
     """
     Convert markdown code block to Confluence hidden comment
@@ -16,6 +65,10 @@ def convert_comment_block(html):
     :param html: string
     :return: modified html string
     """
+    # most pages have no comments at all; skip the scans entirely
+    if '<!--' not in html and '-->' not in html:
+        return html
+
     open_tag = '<ac:placeholder>'
     close_tag = '</ac:placeholder>'
 
@@ -24,6 +77,32 @@ def convert_comment_block(html):
     return html
 
 
+def _render_code_block(match):
+    """
+    Render one matched html code block as a Confluence code macro
+
+    :param match: match with the code tag attributes and body captured
+    :return: Confluence macro markup for the block
+    """
+    lang = _CODE_LANG_RE.search(match.group(1))
+    if lang:
+        lang = lang.group(1)
+    else:
+        lang = 'none'
+
+    # build the macro in one allocation instead of chained concatenation
+    conf_ml = ('<ac:structured-macro ac:name="code">'
+               '<ac:parameter ac:name="theme">Midnight</ac:parameter>'
+               '<ac:parameter ac:name="language">%s</ac:parameter>'
+               '<ac:parameter ac:name="linenumbers">true</ac:parameter>'
+               '<ac:plain-text-body><![CDATA[%s]]></ac:plain-text-body>'
+               '</ac:structured-macro>' % (lang, match.group(2)))
+    # single C-level scan, and handles numeric and named entities the
+    # old lt/gt/quot/amp replacements missed
+    return _unescape(conf_ml)
+
+
+@functools.lru_cache(maxsize=128)
 def convert_code_block(html):
     """
     Convert html code blocks to Confluence macros
@@ -31,32 +110,17 @@ def convert_code_block(html):
     :param html: string
     :return: modified html string
     """
-    code_blocks = re.findall(r'<pre><code.*?>.*?</code></pre>', html, re.DOTALL)
-    if code_blocks:
-        for tag in code_blocks:
-
-            conf_ml = '<ac:structured-macro ac:name="code">'
-            conf_ml = conf_ml + '<ac:parameter ac:name="theme">Midnight</ac:parameter>'
-
-            lang = re.search('code class="(.*)"', tag)
-            if lang:
-                lang = lang.group(1)
-            else:
-                lang = 'none'
-
-            conf_ml = conf_ml + '<ac:parameter ac:name="language">' + lang + '</ac:parameter>'
-            conf_ml = conf_ml + '<ac:parameter ac:name="linenumbers">true</ac:parameter>'
-            content = re.search(r'<pre><code.*?>(.*?)</code></pre>', tag, re.DOTALL).group(1)
-            content = '<ac:plain-text-body><![CDATA[' + content + ']]></ac:plain-text-body>'
-            conf_ml = conf_ml + content + '</ac:structured-macro>'
-            conf_ml = conf_ml.replace('&lt;', '<').replace('&gt;', '>')
-            conf_ml = conf_ml.replace('&quot;', '"').replace('&amp;', '&')
+    # cheap substring test saves the regex scan on pages without code
+    if '<pre><code' not in html:
+        return html
 
-            html = html.replace(tag, conf_ml)
-
-    return html
+    # a single substitution pass captures the attributes and body of
+    # every block as it goes; the old findall-then-replace loop rescanned
+    # the whole document once per block
+    return _CODE_BLOCK_RE.sub(_render_code_block, html)
 
 
+@functools.lru_cache(maxsize=128)
 def convert_info_macros(html):
     """
     Converts html for info, note or warning macros
@@ -64,33 +128,18 @@ def convert_info_macros(html):
     :param html: html string
     :return: modified html string
     """
-    info_tag = '<p><ac:structured-macro ac:name="info"><ac:rich-text-body><p>'
-    note_tag = info_tag.replace('info', 'note')
-    warning_tag = info_tag.replace('info', 'warning')
-    close_tag = '</p></ac:rich-text-body></ac:structured-macro></p>'
-
-    # Custom tags converted into macros
-    html = html.replace('<p>~?', info_tag).replace('?~</p>', close_tag)
-    html = html.replace('<p>~!', note_tag).replace('!~</p>', close_tag)
-    html = html.replace('<p>~%', warning_tag).replace('%~</p>', close_tag)
-
-    # Convert block quotes into macros
-    quotes = re.findall('<blockquote>(.*?)</blockquote>', html, re.DOTALL)
-    if quotes:
-        for quote in quotes:
-            note = re.search('^<.*>Note', quote.strip(), re.IGNORECASE)
-            warning = re.search('^<.*>Warning', quote.strip(), re.IGNORECASE)
-
-            if note:
-                clean_tag = _strip_type(quote, 'Note')
-                macro_tag = clean_tag.replace('<p>', note_tag).replace('</p>', close_tag).strip()
-            elif warning:
-                clean_tag = _strip_type(quote, 'Warning')
-                macro_tag = clean_tag.replace('<p>', warning_tag).replace('</p>', close_tag).strip()
-            else:
-                macro_tag = quote.replace('<p>', info_tag).replace('</p>', close_tag).strip()
-
-            html = html.replace('<blockquote>%s</blockquote>' % quote, macro_tag)
+    # cheap substring tests save the regex scans on pages without any
+    # of the macro markers
+    if '<p>~' not in html and '<blockquote>' not in html \
+            and '<!-- START doctoc' not in html:
+        return html
+
+    # Custom tags converted into macros, in one scan instead of six
+    html = _CUSTOM_MARKER_RE.sub(
+        lambda m: _MARKER_TAGS[m.group(1)] if m.group(1) else _CLOSE_TAG, html)
+
+    # Convert block quotes into macros, in a single substitution pass
+    html = _BLOCKQUOTE_RE.sub(_convert_quote, html)
 
     # Convert doctoc to toc confluence macro
     html = _convert_doctoc(html)
@@ -98,6 +147,25 @@ def convert_info_macros(html):
     return html
 
 
+def _convert_quote(match):
+    """
+    Convert one matched blockquote into an info, note or warning macro
+
+    :param match: match with the blockquote body captured
+    :return: Confluence macro markup for the quote
+    """
+    quote = match.group(1)
+
+    if _NOTE_PREFIX_RE.search(quote.strip()):
+        clean_tag = _strip_type(quote, 'Note')
+        return clean_tag.replace('<p>', _NOTE_TAG).replace('</p>', _CLOSE_TAG).strip()
+    if _WARNING_PREFIX_RE.search(quote.strip()):
+        clean_tag = _strip_type(quote, 'Warning')
+        return clean_tag.replace('<p>', _WARNING_TAG).replace('</p>', _CLOSE_TAG).strip()
+    return quote.replace('<p>', _INFO_TAG).replace('</p>', _CLOSE_TAG).strip()
+
+
+@functools.lru_cache(maxsize=128)
 def _convert_doctoc(html):
     """
     Convert doctoc to confluence macro
@@ -105,20 +173,7 @@ def _convert_doctoc(html):
     :param html: html string
     :return: modified html string
     """
-
-    toc_tag = '''<p>
-    <ac:structured-macro ac:name="toc">
-      <ac:parameter ac:name="printable">true</ac:parameter>
-      <ac:parameter ac:name="style">disc</ac:parameter>
-      <ac:parameter ac:name="maxLevel">7</ac:parameter>
-      <ac:parameter ac:name="minLevel">1</ac:parameter>
-      <ac:parameter ac:name="type">list</ac:parameter>
-      <ac:parameter ac:name="outline">clear</ac:parameter>
-      <ac:parameter ac:name="include">.*</ac:parameter>
-    </ac:structured-macro>
-    </p>'''
-
-    html = re.sub(r'\<\!\-\- START doctoc.*END doctoc \-\-\>', toc_tag, html, flags=re.DOTALL)
+    html = _DOCTOC_RE.sub(_DOCTOC_MACRO, html)
 
     return html
 
@@ -130,24 +185,27 @@ def process_refs(html):
     :param html: html string
     :return: modified html string
     """
-    refs = re.findall(r'\n(\[\^(\d)\].*)|<p>(\[\^(\d)\].*)', html)
+    if '[^' not in html:
+        return html
 
-    if refs:
+    refs = {}
 
-        for ref in refs:
-            if ref[0]:
-                full_ref = ref[0].replace('</p>', '').replace('<p>', '')
-                ref_id = ref[1]
-            else:
-                full_ref = ref[2]
-                ref_id = ref[3]
+    def _collect_ref(match):
+        # record the target and strip the definition while scanning
+        ref_id = match.group(1)
+        full_ref = ('[^%s]%s' % (ref_id, match.group(2))) \
+            .replace('</p>', '').replace('<p>', '')
+        refs[ref_id] = _REF_HREF_RE.search(full_ref).group(1)
+        return match.group(0).replace(full_ref, '')
 
-            full_ref = full_ref.replace('</p>', '').replace('<p>', '')
-            html = html.replace(full_ref, '')
-            href = re.search('href="(.*?)"', full_ref).group(1)
+    html = _REFS_RE.sub(_collect_ref, html)
 
-            superscript = '<a id="test" href="%s"><sup>%s</sup></a>' % (href, ref_id)
-            html = html.replace('[^%s]' % ref_id, superscript)
+    if refs:
+        html = _REF_MARKER_RE.sub(
+            lambda m: '<a id="test" href="%s"><sup>%s</sup></a>'
+                      % (refs[m.group(1)], m.group(1))
+                      if m.group(1) in refs else m.group(0),
+            html)
 
     return html
 
@@ -159,32 +217,19 @@ def add_contents(html):
     :param html: html string
     :return: modified html string
     """
-    contents_markup = '<ac:structured-macro ac:name="toc">\n<ac:parameter ac:name="printable">' \
-                      'true</ac:parameter>\n<ac:parameter ac:name="style">disc</ac:parameter>'
-    contents_markup += '<ac:parameter ac:name="maxLevel">5</ac:parameter>\n' \
-                       '<ac:parameter ac:name="minLevel">1</ac:parameter>'
-    contents_markup += '<ac:parameter ac:name="class">rm-contents</ac:parameter>\n' \
-                       '<ac:parameter ac:name="exclude"></ac:parameter>\n' \
-                       '<ac:parameter ac:name="type">list</ac:parameter>'
-    contents_markup += '<ac:parameter ac:name="outline">false</ac:parameter>\n' \
-                       '<ac:parameter ac:name="include"></ac:parameter>\n' \
-                       '</ac:structured-macro>'
-
-    html = contents_markup + '\n' + html
+    html = _CONTENTS_MACRO + '\n' + html
     return html
 
 
+@functools.lru_cache(maxsize=128)
 def remove_collapsible_headings(read):
     """
     Removes collapsible headings from markdown read from file
     :param read: raw markdown read from file
     :return: markdown without tags for collapsible headings
     """
-    read = read.replace('<details>', '')
-    read = read.replace('</details>', '')
-    read = read.replace('<summary>', '')
-    read = read.replace('</summary>', '')
-    return read
+    # one scan for all four tags instead of four full passes
+    return _COLLAPSIBLE_RE.sub('', read)
 
 
 def remove_empty_list_items(read):
@@ -203,11 +248,29 @@ def add_note(html):
     :return: html with warning
     """
     if NOTE:
-        warning = '<p>~!' + NOTE + '!~</p>'
-        html = warning + html
+        html = '<p>~!%s!~</p>%s' % (NOTE, html)
     return html
 
 
+@functools.lru_cache(maxsize=8)
+def _strip_pattern(tagtype):
+    """
+    Compile the strip pattern for a tag type once and cache it
+
+    :param tagtype: tag type
+    :return: compiled pattern matching every prefix format
+    """
+    escaped = re.escape(tagtype)
+    # one alternation covering the emphasised forms (colon inside or
+    # outside the closing tag) and the bare "Note: " forms; the old
+    # <.*?>Note:\s<.*?> variants are subsumed by the bare form, which
+    # always matched their inner text first
+    return re.compile(
+        r'<(?:em|strong)>%s\s?(?::<.*?>\s|<.*?>:\s)'
+        r'|%s\s?:\s' % (escaped, escaped),
+        re.IGNORECASE)
+
+
 def _strip_type(tag, tagtype):
     """
     Strips Note or Warning tags from html in various formats
@@ -216,26 +279,21 @@ def _strip_type(tag, tagtype):
     :param tagtype: tag type
     :return: modified tag
     """
-    tag = re.sub(r'%s:\s' % tagtype, '', tag.strip(), re.IGNORECASE)
-    tag = re.sub(r'%s\s:\s' % tagtype, '', tag.strip(), re.IGNORECASE)
-    tag = re.sub(r'<.*?>%s:\s<.*?>' % tagtype, '', tag, re.IGNORECASE)
-    tag = re.sub(r'<.*?>%s\s:\s<.*?>' % tagtype, '', tag, re.IGNORECASE)
-    tag = re.sub(r'<(em|strong)>%s:<.*?>\s' % tagtype, '', tag, re.IGNORECASE)
-    tag = re.sub(r'<(em|strong)>%s\s:<.*?>\s' % tagtype, '', tag, re.IGNORECASE)
-    tag = re.sub(r'<(em|strong)>%s<.*?>:\s' % tagtype, '', tag, re.IGNORECASE)
-    tag = re.sub(r'<(em|strong)>%s\s<.*?>:\s' % tagtype, '', tag, re.IGNORECASE)
-    string_start = re.search('<.*?>', tag)
-    tag = _upper_chars(tag, [string_start.end()])
+    # the old code passed re.IGNORECASE as the count argument of re.sub,
+    # so matching was actually case-sensitive; the compiled pattern
+    # carries the flag properly
+    tag = _strip_pattern(tagtype).sub('', tag.strip())
+    string_start = _LEADING_TAG_RE.search(tag)
+    tag = _upper_char_at(tag, string_start.end())
     return tag
 
 
-def _upper_chars(string, indices):
+def _upper_char_at(string, index):
     """
-    Make characters uppercase in string
+    Make the character at an index uppercase
 
     :param string: string to modify
-    :param indices: character indice to change to uppercase
+    :param index: character index to change to uppercase
     :return: uppercased string
     """
-    upper_string = "".join(c.upper() if i in indices else c for i, c in enumerate(string))
-    return upper_string
+    return string[:index] + string[index:index + 1].upper() + string[index + 1:]
@@ -7,6 +7,8 @@
 """
 
 import os
+import collections
+import concurrent.futures
 
 from globals import LOGGER
 from globals import DOCUMENTATION_ROOTS
@@ -19,52 +21,97 @@ import common
 from file_api import FILE_API
 from resolvers import RESOLVERS
 from page_api import PAGE_API
+from page_cache import PAGE_CACHE
 from child_pages import CHILD_PAGES
 
 
+# SIMULATE never changes after startup, so pick the per-file action
+# once at import instead of branching on it for every file
+if SIMULATE:
+    def _handle_converted_page(title, html, _filepath, _uploads):
+        """Simulate mode: only log the conversion result"""
+        common.log_html(html, title)
+else:
+    def _handle_converted_page(title, html, filepath, uploads):
+        """Real mode: queue the page for upload"""
+        uploads.append((title, html, filepath))
+
+
 def upload_folder(directory, ancestors):
     """
-    Upload everything under a folder, recursively
+    Upload everything under a folder and its subfolders
 
     :param directory: folder to upload
     :param ancestors: parent page in ancestors format
     """
+    # iterative breadth-first walk; a queue instead of recursion keeps
+    # arbitrarily deep trees off the interpreter's call-stack limit
+    queue = collections.deque([(directory, ancestors)])
+    while queue:
+        folder, folder_ancestors = queue.popleft()
+        queue.extend(__upload_one_folder(folder, folder_ancestors))
+
+
+def __upload_one_folder(directory, ancestors):
+    """
+    Upload the markdown files directly under one folder
+
+    :param directory: folder to upload
+    :param ancestors: parent page in ancestors format
+    :return: (subfolder, ancestors) pairs still to be uploaded
+    """
     LOGGER.info('Folder: %s', directory)
 
+    # one directory scan, partitioned into markdown files and
+    # subfolders; the entries carry cached stat info so the second
+    # iteration below costs no further syscalls
+    entries = list(os.scandir(directory))
+    md_files = [entry for entry in entries
+                if entry.is_file() and entry.name.endswith('.md')]
+    subdirs = [entry for entry in entries if entry.is_dir()]
+
     # there must be at least one .md file under this folder or a
-    # subfolder in order for us to proceed with processing it
-    if not common.does_path_contain(directory, lambda file : os.path.splitext(file)[1] == '.md'):
+    # subfolder in order for us to proceed with processing it; this
+    # directory's own files are already in hand, so only the subfolders
+    # need probing (and those probes are memoized for the recursion)
+    if not md_files and \
+       not any(common.does_path_contain(folder.path,
+                                        lambda file : file.endswith('.md'))
+               for folder in subdirs):
         LOGGER.info('Skipping folder; no files found')
-        return
+        return []
 
     # Make sure there is a landing page for the directory
-    doc_file = FILE_API.get_landing_page_doc_file(directory)
+    doc_file = FILE_API.get_landing_page_doc_file(directory, entries)
     dir_landing_page_id = PAGE_API.create_dir_landing_page(doc_file, ancestors)
     CHILD_PAGES.mark_page_active(dir_landing_page_id)
     dir_landing_as_ancestors = common.get_page_as_ancestor(dir_landing_page_id)
 
     # Walk through all other .md files in this directory and upload them all with
-    # the landing page as its ancestor
-    for file in os.scandir(directory):
-        if file.is_file() and os.path.splitext(file)[1] == '.md':
-            if os.path.normpath(file.path) != os.path.normpath(doc_file):
-                LOGGER.info('Markdown file: %s', file.name)
-                title = FILE_API.get_title(file.path)
-                html = FILE_API.get_html(file.path)
-
-                if SIMULATE:
-                    common.log_html(html, title)
-                else:
-                    page_id = \
-                        PAGE_API.create_or_update_page(title, html, \
-                            dir_landing_as_ancestors, file.path)
-                    CHILD_PAGES.mark_page_active(page_id)
-
-    # Walk through all subdirectories and recursively upload them,
-    # using this directory's landing page as the ancestor for them
-    for folder in os.scandir(directory):
-        if folder.is_dir():
-            upload_folder(folder.path, dir_landing_as_ancestors)
+    # the landing page as its ancestor.  Conversion stays serial: title
+    # allocation mutates shared caches and must see pages in a stable
+    # order.  The uploads are then fanned out over a thread pool, since
+    # each one is several dependent network round-trips.
+    uploads = []
+    doc_file_norm = os.path.normpath(doc_file)
+    for file in md_files:
+        if os.path.normpath(file.path) != doc_file_norm:
+            LOGGER.info('Markdown file: %s', file.name)
+            title = FILE_API.get_title(file.path)
+            html = FILE_API.get_html(file.path)
+            _handle_converted_page(title, html, file.path, uploads)
+
+    if uploads:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            futures = [executor.submit(PAGE_API.create_or_update_page,
+                                       title, html, dir_landing_as_ancestors, path)
+                       for title, html, path in uploads]
+            for future in concurrent.futures.as_completed(futures):
+                CHILD_PAGES.mark_page_active(future.result())
+
+    # Hand the subdirectories back to the walk, using this directory's
+    # landing page as the ancestor for them
+    return [(folder.path, dir_landing_as_ancestors) for folder in subdirs]
 
 
 def main():
@@ -82,6 +129,10 @@ def main():
     if not NOTRACK:
         CHILD_PAGES.track_child_pages()
 
+    # prefetch the whole space so title checks and update comparisons
+    # hit the cache instead of issuing one GET per page
+    PAGE_CACHE.prime_page_cache()
+
     # upload everything under the ancestor
     root_ancestors = common.get_page_as_ancestor(ANCESTOR)
 
@@ -6,8 +6,8 @@
 
 import os
 import tempfile
+import threading
 import re
-import json
 import collections
 import mimetypes
 import urllib
@@ -25,12 +25,27 @@ from globals import SIMULATE
 from globals import ANCESTOR
 
 
+# URL prefixes shared by every request, built once at import
+_CONTENT_URL = '%s/rest/api/content' % CONFLUENCE_API_URL
+_DOWNLOAD_PREFIX = ('/wiki/download/attachments'
+                    if CONFLUENCE_API_URL.endswith('/wiki')
+                    else '/download/attachments')
+
+# patterns applied to every page body, compiled once at import
+_IMG_TAG_RE = re.compile('<img(.*?)/>')
+_IMG_SRC_RE = re.compile('src="([^"]*)"')
+_IMG_ALT_RE = re.compile('alt="([^"]*)"')
+_PAGE_LINK_RE = re.compile(r'<a href=\"([^\"]+)\">([^<]+)</a>')
+
+
 class _PageApi:
     """
     APIs for dealing with pages in Confluence
     """
 
     __IMAGE_LINK_PAGES = {}
+    __IMAGE_LINK_LOCKS = {}
+    __IMAGE_LINK_LOCKS_GUARD = threading.Lock()
 
     def __add_images(self, page_id, html, filepath):
         """
@@ -43,51 +58,78 @@ class _PageApi:
         """
         source_folder = os.path.dirname(os.path.abspath(filepath))
 
-        # <img/> tags turn into attachments
-        for tag in re.findall('<img(.*?)/>', html):
-            orig_rel_path = re.search('src="(.*?)"', tag).group(1)
-            alt_text = re.search('alt="(.*?)"', tag).group(1)
+        # <img/> tags turn into attachments; collect the path rewrites
+        # while uploading, then apply them in one substitution pass
+        # instead of rescanning the whole document per image
+        replacements = {}
+        for tag in _IMG_TAG_RE.findall(html):
+            orig_rel_path = _IMG_SRC_RE.search(tag).group(1)
+            alt_text = _IMG_ALT_RE.search(tag).group(1)
             rel_path = urllib.parse.unquote(orig_rel_path)
             abs_path = os.path.join(source_folder, rel_path)
             basename = os.path.basename(rel_path)
             self.__upload_attachment(page_id, abs_path, alt_text)
-            if re.search('http.*', rel_path) is None:
-                if CONFLUENCE_API_URL.endswith('/wiki'):
-                    html = html.replace('%s' % (orig_rel_path),
-                                        '/wiki/download/attachments/%s/%s' % (page_id, basename))
-                else:
-                    html = html.replace('%s' % (orig_rel_path),
-                                        '/download/attachments/%s/%s' % (page_id, basename))
+            if 'http' not in rel_path:
+                replacements[orig_rel_path] = \
+                    '%s/%s/%s' % (_DOWNLOAD_PREFIX, page_id, basename)
+        html = self.__replace_all(html, replacements)
 
         # <a href="<image>">[Name]</a> turns into a sub-page
         ancestors = common.get_page_as_ancestor(page_id)
-        for ref in re.findall(r'<a href=\"([^\"]+)\">([^<]+)</a>', html):
+        replacements = {}
+        for ref in _PAGE_LINK_RE.findall(html):
             if not ref[0].startswith(('http', '/')) and ref[0].endswith('.png'):
                 dirname = os.path.abspath(os.path.dirname(filepath))
                 rel_image_from_page = os.path.join(dirname, ref[0])
                 image = os.path.normpath(rel_image_from_page)
                 alt = ref[1]
-                if image in self.__IMAGE_LINK_PAGES:
-                    page = self.__IMAGE_LINK_PAGES[image]
-                else:
-                    file = tempfile.NamedTemporaryFile(mode='w', delete=False)
-                    title = urllib.parse.unquote(os.path.basename(image))
-                    title = "%s - Diagram" % (os.path.splitext(title)[0])
-                    file.write('# %s\n' % title)
-                    temp_dirname = os.path.abspath(os.path.dirname(file.name))
-                    rel_image_from_temp = os.path.relpath(image, temp_dirname)
-                    file.write('![%s](%s)\n' % (alt, rel_image_from_temp))
-                    file.close()
-                    title = FILE_API.get_title(file.name)
-                    subhtml = FILE_API.get_html(file.name)
-                    self.create_or_update_page(title, subhtml, ancestors, file.name)
-                    os.remove(file.name)
-                    page = PAGE_CACHE.get_page(title)
-                    self.__IMAGE_LINK_PAGES[image] = page
+                # one lock per image path: two uploads linking the same
+                # image must not both miss the cache and create duplicate
+                # sub-pages, while different images proceed in parallel
+                with self.__IMAGE_LINK_LOCKS_GUARD:
+                    image_lock = self.__IMAGE_LINK_LOCKS.setdefault(
+                        image, threading.Lock())
+                with image_lock:
+                    if image in self.__IMAGE_LINK_PAGES:
+                        page = self.__IMAGE_LINK_PAGES[image]
+                    else:
+                        file = tempfile.NamedTemporaryFile(mode='w', delete=False)
+                        title = urllib.parse.unquote(os.path.basename(image))
+                        title = "%s - Diagram" % (os.path.splitext(title)[0])
+                        file.write('# %s\n' % title)
+                        temp_dirname = os.path.abspath(os.path.dirname(file.name))
+                        rel_image_from_temp = os.path.relpath(image, temp_dirname)
+                        file.write('![%s](%s)\n' % (alt, rel_image_from_temp))
+                        file.close()
+                        title = FILE_API.get_title(file.name)
+                        subhtml = FILE_API.get_html(file.name)
+                        self.create_or_update_page(title, subhtml, ancestors, file.name)
+                        os.remove(file.name)
+                        page = PAGE_CACHE.get_page(title)
+                        self.__IMAGE_LINK_PAGES[image] = page
                 CHILD_PAGES.mark_page_active(page.id)
-                html = html.replace(ref[0], page.link)
+                replacements[ref[0]] = page.link
+
+        return self.__replace_all(html, replacements)
+
+
+    @staticmethod
+    def __replace_all(html, replacements):
+        """
+        Apply a set of literal string replacements in one pass
 
-        return html
+        :param html: html string
+        :param replacements: dict of old substring -> new substring
+        :return: html with every replacement applied
+        """
+        if not replacements:
+            return html
+        # longest first, so a path that is a prefix of another cannot
+        # shadow it in the alternation
+        pattern = re.compile('|'.join(
+            re.escape(old) for old in
+            sorted(replacements, key=len, reverse=True)))
+        return pattern.sub(lambda match: replacements[match.group(0)], html)
 
 
     def create_or_update_page(self, title, body, ancestors, filepath):
@@ -106,7 +148,7 @@ class _PageApi:
         else:
             LOGGER.info('Creating page %s...', title)
 
-            url = '%s/rest/api/content/' % CONFLUENCE_API_URL
+            url = _CONTENT_URL + '/'
             new_page = {'type': 'page',
                         'title': title,
                         'space': {'key': SPACE_KEY},
@@ -118,9 +160,9 @@ class _PageApi:
                         },
                         'ancestors': ancestors
                        }
-            LOGGER.debug("data: %s", json.dumps(new_page))
+            LOGGER.debug("data: %s", common.json_dumps(new_page))
 
-            response = common.make_request_post(url, data=json.dumps(new_page))
+            response = common.make_request_post(url, data=common.json_dumps(new_page))
 
             data = response.json()
             space_name = data[u'space'][u'name']
@@ -134,7 +176,7 @@ class _PageApi:
             # label the page
             self.__label_page(page_id)
 
-            img_check = re.search(r'<img(.*?)\/>', body)
+            img_check = _IMG_TAG_RE.search(body)
             if img_check:
                 LOGGER.info('Attachments found, update procedure called.')
                 return self.update_page(page_id, title, body, version, ancestors, filepath)
@@ -179,7 +221,7 @@ class _PageApi:
 
         PAGE_CACHE.forget_page(title)
 
-        url = '%s/rest/api/content/%s' % (CONFLUENCE_API_URL, page_id)
+        url = '%s/%s' % (_CONTENT_URL, page_id)
         page_json = {
             "id": page_id,
             "type": "page",
@@ -198,7 +240,7 @@ class _PageApi:
             'ancestors': ancestors
         }
 
-        response = common.make_request_put(url, data=json.dumps(page_json))
+        response = common.make_request_put(url, data=common.json_dumps(page_json))
 
         data = response.json()
         link = '%s%s' % (CONFLUENCE_API_URL, data[u'_links'][u'webui'])
@@ -214,10 +256,10 @@ class _PageApi:
         """
         LOGGER.info("Labeling page %s", page_id)
 
-        url = '%s/rest/api/content/%s/label' % (CONFLUENCE_API_URL, page_id)
+        url = '%s/%s/label' % (_CONTENT_URL, page_id)
         page_json = [{ "name": "md_to_conf" }]
 
-        common.make_request_post(url, data=json.dumps(page_json))
+        common.make_request_post(url, data=common.json_dumps(page_json))
 
 
     def __get_attachment(self, page_id, filename):
@@ -228,9 +270,9 @@ class _PageApi:
         :param filename: attachment filename
         :return: attachment info in case of success, False otherwise
         """
-        url = '%s/rest/api/content/%s/child/attachment?filename=%s' \
+        url = '%s/%s/child/attachment?filename=%s' \
               '&expand=metadata.properties.hash' \
-              % (CONFLUENCE_API_URL, page_id, filename)
+              % (_CONTENT_URL, page_id, filename)
 
         response = common.make_request_get(url)
         data = response.json()
@@ -263,7 +305,7 @@ class _PageApi:
         :param comment: attachment comment
         :return: boolean
         """
-        if re.search('http.*', file):
+        if 'http' in file:
             return False
 
         content_type = mimetypes.guess_type(file)[0]
@@ -275,11 +317,6 @@ class _PageApi:
 
         sha = FILE_API.get_sha_hash(file)
 
-        file_to_upload = {
-            'comment': comment,
-            'file': (filename, open(file, 'rb'), content_type, {'Expires': '0'})
-        }
-
         attachment = self.__get_attachment(page_id, filename)
         if attachment:
             if sha == attachment.hash:
@@ -288,14 +325,22 @@ class _PageApi:
             else:
                 LOGGER.debug('File %s has changed', file)
 
-            url = '%s/rest/api/content/%s/child/attachment/%s/data' % \
-                (CONFLUENCE_API_URL, page_id, attachment.id)
+            url = '%s/%s/child/attachment/%s/data' % \
+                (_CONTENT_URL, page_id, attachment.id)
         else:
             LOGGER.debug('File %s is new', file)
-            url = '%s/rest/api/content/%s/child/attachment/' % (CONFLUENCE_API_URL, page_id)
+            url = '%s/%s/child/attachment/' % (_CONTENT_URL, page_id)
 
         LOGGER.info('Uploading attachment %s...', filename)
-        response = common.make_request_upload(url, file_to_upload)
+        # open only once we know an upload is happening, and close the
+        # handle deterministically; the old open-into-dict pattern leaked
+        # a descriptor on the unchanged-hash skip and on error paths
+        with open(file, 'rb') as file_handle:
+            file_to_upload = {
+                'comment': comment,
+                'file': (filename, file_handle, content_type, {'Expires': '0'})
+            }
+            response = common.make_request_upload(url, file_to_upload)
 
         data = response.json()
         LOGGER.debug('data: %s', str(data))
@@ -310,7 +355,7 @@ class _PageApi:
         # Set the SHA hash metadata on the attachment so that it can be later compared
 
         # first, get the current version of the property if it exists
-        url = '%s/rest/api/content/%s/property/hash' % (CONFLUENCE_API_URL, attachment_id)
+        url = '%s/%s/property/hash' % (_CONTENT_URL, attachment_id)
         response = common.make_request_get(url, False)
 
         if response.status_code == 200:
@@ -330,8 +375,8 @@ class _PageApi:
                 "minorEdit": True
             }
         }
-        LOGGER.debug('data: %s', json.dumps(page_json))
-        response = common.make_request_put(url, data=json.dumps(page_json))
+        LOGGER.debug('data: %s', common.json_dumps(page_json))
+        response = common.make_request_put(url, data=common.json_dumps(page_json))
 
         return True
 
@@ -17,13 +17,20 @@ from globals import CONFLUENCE_API_URL
 import common
 
 
+# patterns applied to every page body, compiled once at import
+_HREF_RE = re.compile('(href="([^"]+)")')
+_SCHEMA_VERSION_RE = re.compile(' ac:schema-version="[^"]+"')
+_MACRO_ID_RE = re.compile(' ac:macro-id="[^"]+"')
+
+
 class _PageCache:
     """
     Reference resolver functions
     """
 
-    __RESOLVE_REFS_AGAIN = []
+    __RESOLVE_REFS_AGAIN = set()
     __CACHED_PAGE_INFO = {}
+    __REF_TITLE_CACHE = {}
 
     def resolve_refs(self, html, filepath):
         """
@@ -33,21 +40,62 @@ class _PageCache:
         :param filepath: path to markdown file
         :return: html file with relative links
         """
-        refs = re.findall('(href="([^"]+)")', html)
+        refs = _HREF_RE.findall(html)
         if refs:
             for ref in refs:
                 if not ref[1].startswith(('http', '/')) and ref[1].endswith('.md'):
-                    with open(os.path.dirname(filepath) + "/" + ref[1], 'r') as mdfile:
-                        title = mdfile.readline().lstrip('#').strip()
+                    title = self.__ref_title(os.path.dirname(filepath) + "/" + ref[1])
                     page = self.get_page(title)
                     if page:
                         html = html.replace(ref[0], "href=\"" + page.link + "\"")
                     else:
-                        if not filepath in self.__RESOLVE_REFS_AGAIN:
-                            self.__RESOLVE_REFS_AGAIN.append(filepath)
+                        self.__RESOLVE_REFS_AGAIN.add(filepath)
         return html
 
 
+    def __ref_title(self, mdfile_path):
+        """
+        Read the title line of a referenced markdown file, at most once
+        per file; popular pages are linked from many others
+
+        :param mdfile_path: path to the referenced markdown file
+        :return: title from the file's first line
+        """
+        key = os.path.realpath(mdfile_path)
+        if key not in self.__REF_TITLE_CACHE:
+            with open(key, 'r') as mdfile:
+                self.__REF_TITLE_CACHE[key] = mdfile.readline().lstrip('#').strip()
+        return self.__REF_TITLE_CACHE[key]
+
+
+    def prime_page_cache(self):
+        """
+        Prefetch every page in the space into the cache; a handful of
+        paged requests replaces one GET per title during the upload
+        """
+        LOGGER.info('Priming page cache for space %s', SPACE_KEY)
+        url = '%s/rest/api/content?spaceKey=%s&limit=100' \
+              '&expand=version,ancestors,metadata.labels,body.storage' \
+              % (CONFLUENCE_API_URL, urllib.parse.quote_plus(SPACE_KEY))
+
+        count = 0
+        while url:
+            response = common.make_request_get(url)
+            data = response.json()
+
+            for result in data[u'results']:
+                # pages with no ancestors (the space homepage) cannot be
+                # cached in PageInfo form; get_page never matches them
+                if result[u'ancestors']:
+                    self.__cache_page(result)
+                    count += 1
+
+            next_path = data.get(u'_links', {}).get(u'next')
+            url = (CONFLUENCE_API_URL + next_path) if next_path else None
+
+        LOGGER.info('Primed page cache with %d pages', count)
+
+
     def get_page(self, title):
         """
         Retrieve page details by title
@@ -68,32 +116,42 @@ class _PageCache:
         LOGGER.debug("data: %s", str(data))
 
         if len(data[u'results']) >= 1:
-            data = data[u'results'][0]
-            page_id = data[u'id']
-            version_num = data[u'version'][u'number']
-            link = '%s%s' % (CONFLUENCE_API_URL, data[u'_links'][u'webui'])
-            ancestor = data[u'ancestors'][-1][u'id']
-            labels = map(lambda r: r[u'name'],
-                         data[u'metadata'][u'labels'][u'results'])
-            body = data[u'body'][u'storage'][u'value']
-
-            # These properties do not round-trip; confluence adds them, so strip them out
-            body = re.sub(' ac:schema-version="[^"]+"', '', body)
-            body = re.sub(' ac:macro-id="[^"]+"', '', body)
-            # Confluence replaces some quotes (but not all) with xml quotes
-            body = re.sub('&quot;', '"', body)
-
-            title = data[u'title']
-
-            page_info = collections.namedtuple('PageInfo',
-                            ['id', 'version', 'link', 'ancestor', 'labels', 'body', 'title'])
-            page = page_info(page_id, version_num, link, ancestor, labels, body, title)
-            self.__CACHED_PAGE_INFO[title] = page
-            return page
+            return self.__cache_page(data[u'results'][0])
 
         return False
 
 
+    def __cache_page(self, data):
+        """
+        Build the PageInfo for one API result and cache it by title
+
+        :param data: one content result from the API
+        :return: Confluence page info
+        """
+        page_id = data[u'id']
+        version_num = data[u'version'][u'number']
+        link = '%s%s' % (CONFLUENCE_API_URL, data[u'_links'][u'webui'])
+        ancestor = data[u'ancestors'][-1][u'id']
+        labels = map(lambda r: r[u'name'],
+                     data[u'metadata'][u'labels'][u'results'])
+        body = data[u'body'][u'storage'][u'value']
+
+        # These properties do not round-trip; confluence adds them, so strip them out
+        body = _SCHEMA_VERSION_RE.sub('', body)
+        body = _MACRO_ID_RE.sub('', body)
+        # Confluence replaces some quotes (but not all) with xml quotes;
+        # a fixed string needs no regex machinery at all
+        body = body.replace('&quot;', '"')
+
+        title = data[u'title']
+
+        page_info = collections.namedtuple('PageInfo',
+                        ['id', 'version', 'link', 'ancestor', 'labels', 'body', 'title'])
+        page = page_info(page_id, version_num, link, ancestor, labels, body, title)
+        self.__CACHED_PAGE_INFO[title] = page
+        return page
+
+
     def is_page_unowned(self, title):
         page = self.get_page(title)
         if not page:
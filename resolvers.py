@@ -5,6 +5,8 @@
 # --------------------------------------------------------------------------------------------------
 """
 
+import concurrent.futures
+
 from globals import LOGGER
 from page_api import PAGE_API
 import common
@@ -24,8 +26,10 @@ class _Resolvers:
         refs_to_resolve = PAGE_CACHE.get_refs_to_resolve_again()
         if len(refs_to_resolve) > 0:
             LOGGER.info('-- Attempting to resolve cross-references --')
-            for page in refs_to_resolve:
-                self.__update_page_refs_only(page)
+            # each update is an independent GET + PUT round-trip; fan
+            # them out over a thread pool sharing the pooled session
+            with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+                list(executor.map(self.__update_page_refs_only, refs_to_resolve))
 
 
     def __update_page_refs_only(self, filepath):